@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+import time
+
+import pygame
+
+# Where resolved font paths are remembered between runs
+FONT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "rhythm_game", "fonts.json")
+ASSETS_LOADED = pygame.event.custom_type()  # Posted when the AssetLoader has finished
+
+
+def read_font_cache():
+    try:
+        with open(FONT_CACHE_PATH) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_font_cache(font_paths):
+    try:
+        os.makedirs(os.path.dirname(FONT_CACHE_PATH), exist_ok=True)
+        with open(FONT_CACHE_PATH, "w") as cache_file:
+            json.dump(font_paths, cache_file)
+    except OSError:
+        pass  # Not being able to cache only costs a font scan next time
+
+
+# Load a font by name without pygame.font.SysFont(), which scans every installed
+# font the first time it is used. None is pygame's bundled default font. Other
+# names are looked up once with match_font() and the path is cached on disk.
+def load_font(name, size):
+    if name is None:
+        return pygame.font.Font(None, size)
+
+    font_paths = read_font_cache()
+    path = font_paths.get(name)
+    if name not in font_paths or (path is not None and not os.path.exists(path)):
+        path = pygame.font.match_font(name)  # Slow, scans the system fonts
+        font_paths[name] = path
+        write_font_cache(font_paths)
+    return pygame.font.Font(path, size)  # A path of None falls back to the default font
+
+
+# Loads the assets of a manifest on a background thread so the window can show
+# straight away. The manifest is a list of (kind, path) and loaders maps each
+# kind to the function that loads it. Load times are kept per asset.
+class AssetLoader:
+    def __init__(self, manifest, loaders):
+        self.manifest = manifest
+        self.loaders = loaders
+        self.load_times = {}  # Path -> ms it took to load
+        self.error = None  # First exception raised by a loader, re-raised by wait()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.load_all, name="asset-loader", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def load_all(self):
+        try:
+            for kind, path in self.manifest:
+                start = time.perf_counter()
+                self.loaders[kind](path)
+                self.load_times[path] = (time.perf_counter() - start) * 1000
+        except Exception as error:
+            self.error = error
+        finally:
+            self.finished.set()
+            pygame.event.post(pygame.event.Event(ASSETS_LOADED))
+
+    def done(self):
+        return self.finished.is_set()
+
+    # Block until everything is loaded
+    def wait(self):
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        for path, load_time in self.load_times.items():
+            print(f"Loaded {path} in {load_time:.1f} ms")
+        print(f"Loaded {len(self.load_times)} assets in {sum(self.load_times.values()):.1f} ms")
@@ -0,0 +1,57 @@
+import os
+import time
+
+import pygame
+
+# Mixer settings. They only take effect if pre_init() runs before pygame.init().
+MIXER_FREQUENCY = 44100
+MIXER_SIZE = -16  # Signed 16 bit samples
+MIXER_CHANNELS = 2  # Stereo
+MIXER_BUFFER = 256  # Samples per audio buffer, smaller means less output latency (pygame uses 512)
+
+# Channel layout
+VOICES_PER_LANE = 4  # Channels reserved for each lane, so fast streams don't cut each other off
+FREE_CHANNELS = 8  # Extra unreserved channels for any other sounds
+
+
+def pre_init(frequency=MIXER_FREQUENCY, buffer=MIXER_BUFFER):
+    pygame.mixer.pre_init(frequency, MIXER_SIZE, MIXER_CHANNELS, buffer)
+
+
+# Plays hit sounds on a pool of channels reserved per lane. When every voice of a
+# lane is busy the one that started longest ago is cut off (voice stealing), so
+# sounds in one lane never take channels from another. Samples are decoded once
+# and shared by every chart that uses the same file.
+class AudioEngine:
+    def __init__(self, lane_count, voices_per_lane=VOICES_PER_LANE):
+        reserved = lane_count * voices_per_lane
+        pygame.mixer.set_num_channels(reserved + FREE_CHANNELS)
+        pygame.mixer.set_reserved(reserved)  # find_channel() and Sound.play() leave these alone
+
+        self.lane_channels = [[pygame.mixer.Channel(lane * voices_per_lane + voice) for voice in range(voices_per_lane)]
+                              for lane in range(lane_count)]
+        self.start_times = [[0.0] * voices_per_lane for _ in range(lane_count)]  # When each voice last started
+        self.sounds = {}  # Absolute path -> decoded Sound
+        self.keysounds = []  # Sound id -> Sound for the chart being played
+
+    # Decoded Sound for a file, loading it the first time it is asked for
+    def load(self, path):
+        path = os.path.abspath(path)
+        sound = self.sounds.get(path)
+        if sound is None:
+            sound = pygame.mixer.Sound(path)
+            self.sounds[path] = sound
+        return sound
+
+    # Set the sounds the current chart plays, indexed by sound id
+    def load_keysounds(self, paths):
+        self.keysounds = [self.load(path) for path in paths]
+
+    def play(self, lane, sound_id):
+        channels = self.lane_channels[lane]
+        start_times = self.start_times[lane]
+        voice = next((voice for voice, channel in enumerate(channels) if not channel.get_busy()), None)
+        if voice is None:
+            voice = start_times.index(min(start_times))  # Steal the oldest voice
+        channels[voice].play(self.keysounds[sound_id])
+        start_times[voice] = time.perf_counter()
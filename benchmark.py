@@ -0,0 +1,109 @@
+import argparse
+import os
+import random
+import tempfile
+import tracemalloc
+
+import pygame
+
+import main
+from chart import write_chart
+
+try:
+    import resource  # Unix only, the RSS column shows "-" without it
+except ImportError:
+    resource = None
+
+STAGES = ["background", "input", "update", "notes", "hud", "display"]
+
+
+# Chart with notes_per_second notes spread at random over the lanes, every tenth one held
+def make_chart(path, notes_per_second, seconds, seed=0):
+    rng = random.Random(seed)
+    note_count = int(notes_per_second * seconds)
+    notes = [(rng.uniform(0, seconds * 1000), rng.randrange(len(main.keys)), 300 if index % 10 == 0 else 0)
+             for index in range(note_count)]
+    write_chart(path, notes, len(main.keys))
+    return notes
+
+
+# Input that presses (and releases) every note right on time, so hits are benchmarked too
+def autoplay_script(notes):
+    script = []
+    for hit_time, lane, duration in notes:
+        key = main.key_map[main.keys[lane]]
+        script.append((int(hit_time), pygame.KEYDOWN, key))
+        script.append((int(hit_time) + max(duration, 50), pygame.KEYUP, key))
+    script.sort(key=lambda event: event[0])
+    return script
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Play a chart headless for a number of frames, stepping the song clock 1/fps per frame.
+# Returns the total time of every frame and the summed time of each stage.
+def run(chart_path, notes, frames, fps):
+    song_clock = main.ManualClock()
+    frame_times = []
+    stage_totals = dict.fromkeys(STAGES, 0.0)
+
+    def on_frame(profiler):
+        frame_times.append(sum(profiler.stages.get(stage, 0.0) for stage in STAGES))
+        for stage in STAGES:
+            stage_totals[stage] += profiler.stages.get(stage, 0.0)
+        song_clock.advance(1000 / fps)
+
+    main.game_loop(chart_path, song_clock, main.ScriptedInput(song_clock, autoplay_script(notes)), frames, on_frame)
+    pygame.mixer.music.stop()
+    return frame_times, stage_totals
+
+
+def run_benchmarks():
+    parser = argparse.ArgumentParser(description="Benchmark the game loop headless on synthetic charts")
+    parser.add_argument("--frames", type=int, default=600, help="frames per run")
+    parser.add_argument("--fps", type=float, default=60, help="simulated frame rate, sets how far the song moves per frame")
+    parser.add_argument("--densities", type=float, nargs="+", default=[2, 10, 30, 100], help="notes per second")
+    parser.add_argument("--resolutions", nargs="+", default=["640x480", "1280x853", "1920x1080"])
+    parser.add_argument("--dirty-rects", action="store_true", help="use the dirty rectangle renderer")
+    parser.add_argument("--no-memory", action="store_true", help="skip the extra run that measures peak memory")
+    args = parser.parse_args()
+
+    main.TARGET_FPS = 0  # Run flat out, the song clock is stepped by hand
+    main.DIRTY_RECTS = args.dirty_rects
+    seconds = args.frames / args.fps
+
+    print("Frame times and per-stage means in ms")
+    print(f"{'resolution':>10} {'notes/s':>7} {'p50':>6} {'p95':>6} {'p99':>6} {'max':>6}  "
+          + " ".join(f"{stage:>10}" for stage in STAGES) + f" {'peak MB':>8} {'rss MB':>7}")
+    with tempfile.TemporaryDirectory() as chart_dir:
+        for resolution in args.resolutions:
+            width, height = (int(size) for size in resolution.split("x"))
+            main.init(width, height, headless=True)
+            for density in args.densities:
+                chart_path = os.path.join(chart_dir, f"{density:g}.chart")
+                notes = make_chart(chart_path, density, seconds)
+                frame_times, stage_totals = run(chart_path, notes, args.frames, args.fps)
+
+                peak = ""
+                if not args.no_memory:
+                    tracemalloc.start()
+                    run(chart_path, notes, args.frames, args.fps)
+                    peak = f"{tracemalloc.get_traced_memory()[1] / 2 ** 20:8.2f}"
+                    tracemalloc.stop()
+                rss = "-"
+                if resource:
+                    rss = f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:7.1f}"  # Peak for the whole process
+
+                print(f"{resolution:>10} {density:>7g} {percentile(frame_times, 0.5):6.2f} "
+                      f"{percentile(frame_times, 0.95):6.2f} {percentile(frame_times, 0.99):6.2f} "
+                      f"{max(frame_times):6.2f}  "
+                      + " ".join(f"{stage_totals[stage] / len(frame_times):10.3f}" for stage in STAGES)
+                      + f" {peak:>8} {rss:>7}")
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    run_benchmarks()
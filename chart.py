@@ -0,0 +1,177 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+
+# Chart file layout (little endian):
+#   header   - magic, format version, lane count, note count, metadata length
+#   metadata - UTF-8 JSON object, e.g. {"song": "megalovania.mp3", "keysounds": ["red_sound.wav", ...]}
+#   notes    - fixed size records sorted by time: time (ms), duration (ms), lane
+# Fixed size records mean the file can be memory mapped and read one note at a
+# time, so even huge charts are never loaded as Python objects up front.
+CHART_MAGIC = b"RGCH"
+CHART_VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+NOTE = struct.Struct("<IHBx")
+MAX_TIME = 2 ** 32 - 1  # Largest values the note record fields can hold
+MAX_DURATION = 2 ** 16 - 1
+MAX_LANE = 2 ** 8 - 1
+
+
+# Write a chart file. notes is an iterable of (time, lane, duration) in any order.
+def write_chart(path, notes, lane_count=4, metadata=None):
+    notes = sorted((int(time), int(lane), int(duration)) for time, lane, duration in notes)
+    for time, lane, duration in notes:
+        if not 0 <= lane < lane_count:
+            raise ValueError(f"note at {time} ms is in lane {lane}, chart only has {lane_count} lanes")
+
+    metadata_bytes = json.dumps(metadata or {}).encode("utf-8")
+    with open(path, "wb") as chart_file:
+        chart_file.write(HEADER.pack(CHART_MAGIC, CHART_VERSION, lane_count, len(notes), len(metadata_bytes)))
+        chart_file.write(metadata_bytes)
+        for time, lane, duration in notes:
+            chart_file.write(NOTE.pack(time, duration, lane))
+
+
+# A chart file opened for reading. Notes are read straight out of the memory map,
+# in time order through a ChartCursor. There is no per-lane index: judgement only
+# needs the notes of a lane that are on screen, and NoteStore keeps those in a
+# queue per lane as they spawn.
+class Chart:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        if os.fstat(self.file.fileno()).st_size < HEADER.size:
+            self.file.close()
+            raise ValueError(f"{path} is not a chart file")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.lane_count, self.note_count, metadata_length = HEADER.unpack_from(self.data, 0)
+        if magic != CHART_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a chart file")
+        if version != CHART_VERSION:
+            self.close()
+            raise ValueError(f"{path} uses chart format version {version}, expected {CHART_VERSION}")
+
+        self.notes_offset = HEADER.size + metadata_length
+        if len(self.data) < self.notes_offset + self.note_count * NOTE.size:
+            self.close()
+            raise ValueError(f"{path} is truncated")
+        self.metadata = json.loads(self.data[HEADER.size:self.notes_offset].decode("utf-8") or "{}")
+
+    def __len__(self):
+        return self.note_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if not self.data.closed:
+            self.data.close()
+        self.file.close()
+
+    # Return (time, lane, duration) of the note at the given position
+    def note(self, index):
+        time, duration, lane = NOTE.unpack_from(self.data, self.notes_offset + index * NOTE.size)
+        return time, lane, duration
+
+    # Path of the song the chart was made for, relative paths are taken from the chart's folder
+    def song_path(self):
+        song = self.metadata.get("song")
+        if song is None:
+            return None
+        return os.path.join(os.path.dirname(self.path), song)
+
+    # Hit sound files by lane, relative paths are taken from the chart's folder
+    def keysound_paths(self):
+        return [os.path.join(os.path.dirname(self.path), keysound) for keysound in self.metadata.get("keysounds", [])]
+
+    def cursor(self):
+        return ChartCursor(self)
+
+
+# Walks a chart in time order. Each call only reads the notes that became due.
+class ChartCursor:
+    def __init__(self, chart):
+        self.chart = chart
+        self.index = 0  # Next note to hand out
+        self.last_time = 0
+
+    def done(self):
+        return self.index >= len(self.chart)
+
+    # Return every note with time <= until that has not been returned yet
+    def due(self, until):
+        notes = []
+        while self.index < len(self.chart):
+            time, lane, duration = self.chart.note(self.index)
+            if time > until:
+                break
+            if time < self.last_time:
+                raise ValueError(f"{self.chart.path}: note {self.index} is out of time order")
+            self.last_time = time
+            notes.append((time, lane, duration))
+            self.index += 1
+        return notes
+
+
+# Read a text chart: one "time lane [duration]" line per note, # starts a comment
+def read_text_chart(path):
+    notes = []
+    with open(path) as text_file:
+        for line_number, line in enumerate(text_file, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) not in (2, 3):
+                raise ValueError(f"{path}:{line_number}: expected 'time lane [duration]'")
+            time, lane = int(fields[0]), int(fields[1])
+            duration = int(fields[2]) if len(fields) == 3 else 0
+            if not 0 <= time <= MAX_TIME:
+                raise ValueError(f"{path}:{line_number}: time must be between 0 and {MAX_TIME} ms")
+            if not 0 <= lane <= MAX_LANE:
+                raise ValueError(f"{path}:{line_number}: lane must be between 0 and {MAX_LANE}")
+            if not 0 <= duration <= MAX_DURATION:
+                raise ValueError(f"{path}:{line_number}: duration must be between 0 and {MAX_DURATION} ms")
+            notes.append((time, lane, duration))
+    return notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile or inspect rhythm game charts")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compile_parser = commands.add_parser("compile", help="convert a text chart to a chart file")
+    compile_parser.add_argument("text_chart")
+    compile_parser.add_argument("chart")
+    compile_parser.add_argument("--song", help="song file, relative to the chart")
+    compile_parser.add_argument("--keysounds", nargs="+", help="hit sound file for each lane, relative to the chart")
+    compile_parser.add_argument("--lanes", type=int, default=4)
+
+    dump_parser = commands.add_parser("dump", help="print the notes of a chart file")
+    dump_parser.add_argument("chart")
+
+    args = parser.parse_args()
+    if args.command == "compile" and args.keysounds and len(args.keysounds) != args.lanes:
+        parser.error(f"--keysounds needs one sound per lane, got {len(args.keysounds)} for {args.lanes} lanes")
+    if args.command == "compile":
+        metadata = {}
+        if args.song:
+            metadata["song"] = args.song
+        if args.keysounds:
+            metadata["keysounds"] = args.keysounds
+        write_chart(args.chart, read_text_chart(args.text_chart), args.lanes, metadata)
+    else:
+        with Chart(args.chart) as chart:
+            print(f"# {len(chart)} notes, {chart.lane_count} lanes, metadata {json.dumps(chart.metadata)}")
+            for index in range(len(chart)):
+                print(*chart.note(index))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from chart import Chart, write_chart
+
+# Analysis settings. Changing any of them changes GENERATOR_VERSION so old cache entries are not reused.
+SAMPLE_RATE = 22050
+FRAME_SIZE = 1024  # STFT window, ~46 ms
+HOP_SIZE = 512  # ~23 ms between spectral frames
+BLOCK_FRAMES = 1024  # Spectral frames analysed at once, bounds memory on long songs
+PEAK_RADIUS = 3  # An onset has to be the largest flux within this many frames either side
+PEAK_THRESHOLD = 0.1  # How far above the local mean flux an onset has to be, relative to the peak flux
+MIN_GAP_MS = 120  # Shortest gap between two notes in the same lane
+LANE_COUNT = 4  # Lanes d, f, j, k: low to high frequency bands
+GENERATOR_VERSION = f"1-{SAMPLE_RATE}-{FRAME_SIZE}-{HOP_SIZE}-{PEAK_RADIUS}-{PEAK_THRESHOLD}-{MIN_GAP_MS}-{LANE_COUNT}"
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rhythm_game", "charts")
+AUDIO_EXTENSIONS = (".mp3", ".ogg", ".wav", ".flac")
+
+
+# Decode a song to mono float samples at SAMPLE_RATE with pygame's mixer
+def decode(path):
+    import pygame
+    sound = pygame.mixer.Sound(path)
+    samples = pygame.sndarray.array(sound).astype(np.float32)
+    if samples.ndim == 2:
+        samples = samples.mean(axis=1)
+    return samples / 32768
+
+
+# Magnitude spectrum of every frame in a block, shape (frames, FRAME_SIZE // 2 + 1)
+def spectrum(samples, first_frame, frame_count):
+    start = first_frame * HOP_SIZE
+    block = samples[start:start + (frame_count - 1) * HOP_SIZE + FRAME_SIZE]
+    frames = np.lib.stride_tricks.sliding_window_view(block, FRAME_SIZE)[::HOP_SIZE]
+    return np.log1p(10 * np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE), axis=1)))
+
+
+# Spectral flux (summed rise in log magnitude) per frame, overall and per lane band
+def spectral_flux(samples):
+    frame_count = max(0, (len(samples) - FRAME_SIZE) // HOP_SIZE + 1)
+    # Lane bands split the spectrum on a log scale from ~40 Hz up
+    bin_hz = SAMPLE_RATE / FRAME_SIZE
+    edges = np.geomspace(40 / bin_hz, FRAME_SIZE // 2, LANE_COUNT + 1).astype(int)
+    edges[0] = 0
+    flux = np.zeros(frame_count, np.float32)
+    band_flux = np.zeros((frame_count, LANE_COUNT), np.float32)
+
+    previous = None
+    for first_frame in range(0, frame_count, BLOCK_FRAMES):
+        magnitudes = spectrum(samples, first_frame, min(BLOCK_FRAMES, frame_count - first_frame))
+        if previous is None:
+            previous = magnitudes[:1]
+        rise = np.maximum(np.diff(np.concatenate([previous, magnitudes]), axis=0), 0)
+        flux[first_frame:first_frame + len(rise)] = rise.sum(axis=1)
+        band_flux[first_frame:first_frame + len(rise)] = np.add.reduceat(rise, edges[:-1], axis=1)
+        previous = magnitudes[-1:]
+    return flux, band_flux
+
+
+# Frames where the flux peaks clearly above its surroundings
+def pick_onsets(flux):
+    if len(flux) == 0 or flux.max() <= 0:
+        return np.zeros(0, int)
+    width = 2 * PEAK_RADIUS + 1
+    padded = np.pad(flux, PEAK_RADIUS, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width)
+    local_max = windows.max(axis=1)
+    local_mean = np.convolve(padded, np.ones(4 * width) / (4 * width), mode="same")[PEAK_RADIUS:-PEAK_RADIUS]
+    is_peak = (flux == local_max) & (flux >= local_mean + PEAK_THRESHOLD * flux.max())
+    return np.flatnonzero(is_peak)
+
+
+# Tempo in BPM from the autocorrelation of the flux, searched between 60 and 200 BPM
+def estimate_tempo(flux):
+    frames_per_second = SAMPLE_RATE / HOP_SIZE
+    centred = flux - flux.mean()
+    if len(centred) < 2 or not centred.any():
+        return 0.0
+    size = 1 << int(np.ceil(np.log2(2 * len(centred))))
+    spectrum_power = np.abs(np.fft.rfft(centred, size)) ** 2
+    autocorrelation = np.fft.irfft(spectrum_power, size)[:len(centred)]
+    min_lag = int(frames_per_second * 60 / 200)
+    max_lag = min(int(frames_per_second * 60 / 60), len(autocorrelation) - 1)
+    if max_lag <= min_lag:
+        return 0.0
+    lag = min_lag + int(np.argmax(autocorrelation[min_lag:max_lag + 1]))
+    return 60 * frames_per_second / lag
+
+
+# Turn a song into chart notes: (time ms, lane, duration ms), plus the tempo
+def analyse(path):
+    samples = decode(path)
+    flux, band_flux = spectral_flux(samples)
+    onsets = pick_onsets(flux)
+    lanes = np.argmax(band_flux[onsets], axis=1)  # Lane of the band that rose the most
+    times = (onsets * HOP_SIZE + FRAME_SIZE // 2) * 1000 // SAMPLE_RATE
+
+    notes = []
+    last_time = [-MIN_GAP_MS] * LANE_COUNT
+    for note_time, lane in zip(times.tolist(), lanes.tolist()):
+        if note_time - last_time[lane] >= MIN_GAP_MS:
+            notes.append((note_time, lane, 0))
+            last_time[lane] = note_time
+    return notes, estimate_tempo(flux)
+
+
+def file_hash(path):
+    digest = hashlib.sha256(GENERATOR_VERSION.encode())
+    with open(path, "rb") as audio_file:
+        for chunk in iter(lambda: audio_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Worker: make the chart for one song, reusing the cached analysis when the audio is unchanged
+def generate(job):
+    song_path, chart_path, cache_dir = job
+    start = time.perf_counter()
+    cache_path = os.path.join(cache_dir, file_hash(song_path) + ".chart")
+    cached = os.path.exists(cache_path)
+    if cached:
+        with Chart(cache_path) as cached_chart:
+            notes = [cached_chart.note(index) for index in range(len(cached_chart))]
+            tempo = cached_chart.metadata.get("bpm", 0.0)
+    else:
+        notes, tempo = analyse(song_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        partial_path = f"{cache_path}.{os.getpid()}.tmp"
+        write_chart(partial_path, notes, LANE_COUNT, {"bpm": tempo})
+        os.replace(partial_path, cache_path)  # Another worker may be caching the same song
+
+    song = os.path.relpath(song_path, os.path.dirname(os.path.abspath(chart_path)))
+    write_chart(chart_path, notes, LANE_COUNT, {"song": song, "bpm": tempo})
+    return song_path, chart_path, len(notes), tempo, cached, time.perf_counter() - start
+
+
+def init_worker():
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    import pygame
+    pygame.mixer.init(SAMPLE_RATE, -16, 1)
+
+
+# Songs given on the command line, folders are searched for audio files
+def find_songs(paths):
+    songs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, file_names in os.walk(path):
+                songs.extend(os.path.join(folder, file_name) for file_name in sorted(file_names)
+                             if file_name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            songs.append(path)
+    return songs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate charts from songs by onset detection")
+    parser.add_argument("songs", nargs="+", help="audio files or folders of them")
+    parser.add_argument("--out", help="folder for the charts (default: next to each song)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--cache", default=CACHE_DIR, help="analysis cache folder")
+    args = parser.parse_args()
+
+    jobs = []
+    for song_path in find_songs(args.songs):
+        chart_name = os.path.splitext(os.path.basename(song_path))[0] + ".chart"
+        jobs.append((song_path, os.path.join(args.out or os.path.dirname(song_path), chart_name), args.cache))
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    pool = multiprocessing.Pool(min(args.jobs, len(jobs)) or 1, initializer=init_worker)
+    try:
+        for song_path, chart_path, note_count, tempo, cached, seconds in pool.imap_unordered(generate, jobs):
+            source = "cached" if cached else "analysed"
+            print(f"{chart_path}: {note_count} notes, {tempo:.0f} BPM ({source} in {seconds:.2f} s)")
+    finally:
+        # Let the workers exit on their own, pygame's signal handlers keep terminate() from stopping them
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,22 @@
+import numpy as np
+import os
 import pygame 
 import random
+import sys
 import time
+from collections import OrderedDict, deque
 
-# Initialize Pygame
-pygame.init()
+import audio
+from assets import AssetLoader, load_font
+from audio import AudioEngine
+from chart import Chart
+from profiler import FrameProfiler
+from replay import KEY_DOWN, KEY_UP, NO_LANE, ReplayWriter
 
 # Screen dimensions
 SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 853
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Rhythm Game")
+screen = None  # Window surface, created by init()
 
 # Colors
 WHITE = (255, 255, 255)
@@ -22,112 +29,555 @@ BLACK = (0, 0, 0)
 # Game Variables
 note_speed = 7  # Speed of the notes
 note_height = 160  # Increased the height of the blocks
-score = 0
-misses = 0
 
-# Font for score and text
-font = pygame.font.SysFont(None, 40)  # Adjusted font size for larger screen
-title_font = pygame.font.SysFont(None, 80)  # Larger title font
+# Timing (all in song milliseconds, so notes stay in sync however the frame rate behaves)
+TARGET_FPS = 60  # Frame rate cap, 0 = uncapped
+NOTE_SPEED = note_speed * 60 / 1000  # Pixels per millisecond (note_speed pixels per frame at 60 FPS)
+HIT_WINDOW_MS = (note_height + 20) / 2 / NOTE_SPEED  # Early/late window, same as the old note/hit zone overlap
+AUDIO_SYNC_SMOOTHING = 0.1  # How quickly the song clock follows the music position
+INPUT_POLL_MS = 1  # How often input is polled while waiting for the next frame
+
+# Rendering options
+DIRTY_RECTS = False  # Only push the changed parts of the screen instead of the whole window
+DIRTY_RECT_THRESHOLD = 0.5  # Fall back to a full refresh once this fraction of the screen is dirty
+TEXT_CACHE_BUDGET = 4 * 1024 * 1024  # Max bytes of rendered text surfaces kept around
+IDLE_FPS = 10  # Max redraws per second on the start screen
+BLINK_INTERVAL = 0.5  # Seconds between blinks of the start screen text
+PROFILER_OVERLAY = False  # Show the performance overlay from the start (F3 toggles it, F4 exports the profile)
+
+# Replays of every game are saved here (None turns recording off), re-score them with replay.py
+REPLAY_DIR = "replays"
+
+# Font for score and text, loaded by init()
+FONT_NAME = None  # System font name, None for pygame's bundled font
+font = None
+title_font = None
+small_font = None  # For the performance overlay
 
 # Key mappings for player input (only 4 keys: d, f, j, k)
 keys = ['d', 'f', 'j', 'k']
 key_map = {'d': pygame.K_d, 'f': pygame.K_f, 'j': pygame.K_j, 'k': pygame.K_k}
 
-# Lane width (equal for all keys)
-lane_width = SCREEN_WIDTH // len(keys)
-
-# Key lane positions (evenly distributed across the screen width)
-lane_positions = {
-    'd': lane_width * 0,    # Lane for key D
-    'f': lane_width * 1,    # Lane for key F
-    'j': lane_width * 2,    # Lane for key J
-    'k': lane_width * 3     # Lane for key K
-}
-
-# Load sounds for each block (Ensure these files are present in your project directory)
-red_sound = pygame.mixer.Sound("red_sound.wav")   # Replace with actual file paths
-blue_sound = pygame.mixer.Sound("blue_sound.wav") 
-orange_sound = pygame.mixer.Sound("orange_sound.wav") 
-green_sound = pygame.mixer.Sound("green_sound.wav") 
-
-# Load background music (make sure this file exists)
-pygame.mixer.music.load("megalovania.mp3")  # Replace with the path to your music file
-
-# Define the Note class
-class Note:
-    def __init__(self, key, y, color, sound):
-        self.key = key
-        self.x = lane_positions[key] + lane_width // 2  # Center the note within the lane
-        self.y = y
-        self.rect = pygame.Rect(self.x - lane_width // 4, self.y, lane_width // 2, note_height)  # Adjusted width for block
-        self.color = color  # Color for the note (Red, Blue, Orange, Green)
-        self.sound = sound  # Sound associated with the note
-    
-    def move(self):
-        self.y += note_speed
-        self.rect.y = self.y
-    
-    def draw(self):
-        pygame.draw.rect(screen, self.color, self.rect)
+# Work out everything that depends on the screen size
+def set_resolution(width, height):
+    global SCREEN_WIDTH, SCREEN_HEIGHT, lane_width, lane_positions, HIT_LINE_Y, NOTE_LEAD_MS
+    SCREEN_WIDTH = width
+    SCREEN_HEIGHT = height
+
+    # Lane width (equal for all keys)
+    lane_width = SCREEN_WIDTH // len(keys)
+
+    # Key lane positions (evenly distributed across the screen width)
+    lane_positions = {
+        'd': lane_width * 0,    # Lane for key D
+        'f': lane_width * 1,    # Lane for key F
+        'j': lane_width * 2,    # Lane for key J
+        'k': lane_width * 3     # Lane for key K
+    }
+
+    HIT_LINE_Y = SCREEN_HEIGHT - 90  # Middle of the hit zone bar
+    NOTE_LEAD_MS = (HIT_LINE_Y - note_height // 2) / NOTE_SPEED  # Time a note takes from the top to the hit line
+
+set_resolution(SCREEN_WIDTH, SCREEN_HEIGHT)
+
+# Sounds for each block (Ensure these files are present in your project directory)
+hit_sound_files = ["red_sound.wav", "blue_sound.wav", "orange_sound.wav", "green_sound.wav"]  # Replace with actual file paths
+audio_engine = None  # Created by init()
+
+# Everything loaded in the background while the start screen shows
+asset_manifest = [("sound", path) for path in hit_sound_files] + [
+    ("music", "megalovania.mp3"),  # Background music (make sure this file exists)
+]
+asset_loader = None  # Started by init()
+
+# Colour for each lane, in chart lane order
+lane_colors = [RED, BLUE, ORANGE, GREEN]
+
+# Initialize Pygame, open the window and load the sounds. Headless runs use SDL's
+# dummy video and audio drivers, so no window or sound card is needed.
+def init(width=SCREEN_WIDTH, height=SCREEN_HEIGHT, headless=False):
+    global screen, font, title_font, small_font, audio_engine, asset_loader
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+    # Only start the parts of pygame the game uses, pygame.init() starts all of them.
+    # Low latency mixer settings have to be set before the mixer starts.
+    audio.pre_init()
+    pygame.display.init()
+    pygame.font.init()
+    pygame.mixer.init()
+
+    set_resolution(width, height)
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Rhythm Game")
+
+    font = load_font(FONT_NAME, 40)  # Adjusted font size for larger screen
+    title_font = load_font(FONT_NAME, 80)  # Larger title font
+    small_font = load_font(FONT_NAME, 24)
+
+    # Sounds and music load in the background, the game waits for them in game_loop()
+    audio_engine = AudioEngine(len(keys))
+    asset_loader = AssetLoader(asset_manifest, {"sound": audio_engine.load, "music": pygame.mixer.music.load})
+    asset_loader.start()
+
+# Song clock in milliseconds. It runs on the high resolution timer and is nudged
+# towards pygame.mixer.music.get_pos(), which only moves once per audio buffer,
+# so notes follow the music without inheriting its jitter.
+class SongClock:
+    def __init__(self, smoothing=AUDIO_SYNC_SMOOTHING):
+        self.smoothing = smoothing
+        self.start()
+
+    # Call right after the music starts playing
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.offset = 0.0  # Smoothed difference between the music position and the timer
+        self.last_music_pos = -1
+        self.last_time = 0.0
+
+    def now(self):
+        timer_time = (time.perf_counter() - self.start_time) * 1000
+        music_pos = pygame.mixer.music.get_pos()  # -1 when no music is playing
+        if music_pos >= 0 and music_pos != self.last_music_pos:
+            self.last_music_pos = music_pos
+            self.offset += (music_pos - timer_time - self.offset) * self.smoothing
+        self.last_time = max(timer_time + self.offset, self.last_time)  # Never run backwards
+        return self.last_time
+
+# Collects pygame events stamped with the song time they were read at. SDL only
+# lets the thread that opened the window pump events, so rather than a separate
+# thread the main loop hands its idle time to wait_until(): instead of sleeping
+# the rest of the frame it polls every INPUT_POLL_MS. Judgement uses these
+# timestamps instead of the time the frame gets round to the events. They are
+# only ~1 ms accurate while the loop is idle, events that arrive while a frame
+# is being drawn get the time of the next poll (at best the one before the
+# flip), and with TARGET_FPS = 0 input is only polled twice per frame.
+class InputCapture:
+    def __init__(self, song_clock, poll_interval=INPUT_POLL_MS):
+        self.song_clock = song_clock
+        self.poll_interval = poll_interval / 1000
+        self.events = deque()  # (song time, event), oldest first
+
+    def poll(self):
+        events = pygame.event.get()
+        if events:
+            event_time = self.song_clock.now()
+            self.events.extend((event_time, event) for event in events)
+
+    # Keep polling until the time.perf_counter() deadline
+    def wait_until(self, deadline):
+        self.poll()
+        remaining = deadline - time.perf_counter()
+        while remaining > 0:
+            time.sleep(min(self.poll_interval, remaining))
+            self.poll()
+            remaining = deadline - time.perf_counter()
+
+    # Hand out every captured event in the order it arrived
+    def drain(self):
+        while self.events:
+            yield self.events.popleft()
+
+# Note states
+NOTE_FREE = 0  # Slot is unused and can be reused by the next spawn
+NOTE_ACTIVE = 1  # Falling and can still be hit
+NOTE_MISSED = 2  # Hit window has passed, the note just falls off screen
+NOTE_HELD = 3  # Held note whose head was hit, waiting for the key to be released
+
+# All notes on screen, stored as parallel arrays instead of one object per note.
+# Every frame is a single vectorized update, and slots of removed notes are
+# reused so a busy chart does not keep allocating. Each lane also keeps a queue
+# of its hittable notes in hit time order, so a key press only looks at the
+# front of its own lane.
+class NoteStore:
+    def __init__(self, capacity=64):
+        self.lane = np.zeros(capacity, np.int8)
+        self.hit_time = np.zeros(capacity)  # Song time (ms) at which the note reaches the hit line
+        self.duration = np.zeros(capacity)  # Hold length in ms, 0 for a plain tap
+        self.y = np.zeros(capacity)  # Top of the note block (the hold tail sits above it)
+        self.state = np.zeros(capacity, np.uint8)
+        self.sound = np.zeros(capacity, np.int16)  # Index into audio_engine.keysounds
+        self.free_slots = list(range(capacity - 1, -1, -1))  # Lowest slot is handed out first
+        self.lanes = [deque() for _ in keys]  # Slots of the hittable notes of each lane, earliest first
+        self.holding = [None] * len(keys)  # Slot of the held note in each lane
+
+    def __len__(self):
+        return len(self.state) - len(self.free_slots)
+
+    # Double the capacity, existing slots keep their index
+    def grow(self):
+        capacity = len(self.state)
+        for name in ("lane", "hit_time", "duration", "y", "state", "sound"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def spawn(self, lane, hit_time, duration=0, sound=None):
+        if not self.free_slots:
+            self.grow()
+        slot = self.free_slots.pop()
+        self.lane[slot] = lane
+        self.hit_time[slot] = hit_time
+        self.duration[slot] = duration
+        self.y[slot] = -note_height
+        self.state[slot] = NOTE_ACTIVE
+        self.sound[slot] = lane if sound is None else sound
+        self.lanes[lane].append(slot)  # Notes of a lane are always spawned in hit time order
+        return slot
+
+    def remove(self, slot):
+        self.state[slot] = NOTE_FREE
+        self.free_slots.append(slot)
+
+    # Move every note to where it should be at song_time, flag notes whose hit window
+    # has passed and free the ones that fell off screen. Returns the number of new misses.
+    def update(self, song_time):
+        self.y = HIT_LINE_Y - note_height // 2 - (self.hit_time - song_time) * NOTE_SPEED
+        late = (self.state == NOTE_ACTIVE) & (song_time - self.hit_time > HIT_WINDOW_MS)
+        self.state[late] = NOTE_MISSED
+        for queue in self.lanes:  # Missed notes are always at the front of their lane
+            while queue and self.state[queue[0]] == NOTE_MISSED:
+                queue.popleft()
+        # Held notes are left alone, they are freed through holding by release() or finish_holds()
+        off_screen = self.y - self.duration * NOTE_SPEED > SCREEN_HEIGHT
+        gone = (self.state != NOTE_FREE) & (self.state != NOTE_HELD) & off_screen
+        self.state[gone] = NOTE_FREE
+        self.free_slots.extend(np.flatnonzero(gone).tolist())
+        return int(np.count_nonzero(late))
+
+    # Judge a key press in a lane. Returns the slot of the note that was hit, or None.
+    # A hit held note stays on screen until release() or finish_holds().
+    def press(self, lane, press_time):
+        queue = self.lanes[lane]
+        while queue and press_time - self.hit_time[queue[0]] > HIT_WINDOW_MS:
+            queue.popleft()  # Too late for this one, update() will count the miss
+        if not queue or self.hit_time[queue[0]] - press_time > HIT_WINDOW_MS:
+            return None  # Nothing close enough in this lane
+        slot = queue.popleft()
+        if self.duration[slot] > 0:
+            self.state[slot] = NOTE_HELD
+            self.holding[lane] = slot
+        else:
+            self.remove(slot)
+        return slot
+
+    # Judge a key release in a lane. Returns True if a held note was let go in time,
+    # False if it was let go too early and None if nothing was being held.
+    def release(self, lane, release_time):
+        slot = self.holding[lane]
+        if slot is None:
+            return None
+        self.holding[lane] = None
+        held_to_end = release_time >= self.hit_time[slot] + self.duration[slot] - HIT_WINDOW_MS
+        self.remove(slot)
+        return held_to_end
+
+    # Complete held notes that were held to the end. Returns how many finished.
+    def finish_holds(self, song_time):
+        finished = 0
+        for lane, slot in enumerate(self.holding):
+            if slot is not None and song_time >= self.hit_time[slot] + self.duration[slot]:
+                self.holding[lane] = None
+                self.remove(slot)
+                finished += 1
+        return finished
+
+    # Slots of every note that is on screen
+    def live_slots(self):
+        return np.flatnonzero(self.state != NOTE_FREE)
+
+# Random note gaps in ms for each lane: Red, Blue, Orange, Green
+random_note_gaps = [(500, 2000), (1000, 3000), (1500, 4000), (1500, 2000)]
+RANDOM_START_MS = 2500  # Random notes start after this (plus their first gap) so the first ones fall from the top
+
+# The notes and judgement of one play, without any drawing or sound. Notes come
+# from the chart when one is given, otherwise at random from seed. Every lane
+# draws from its own generator and notes are judged on their timestamps alone,
+# so feeding the same key events gives the same score however often advance()
+# is called in between. This is what lets replays be re-simulated headless.
+class GameSession:
+    def __init__(self, chart=None, seed=0):
+        if chart and chart.lane_count > len(keys):
+            raise ValueError(f"{chart.path} has {chart.lane_count} lanes, the game only has {len(keys)}")
+        self.note_store = NoteStore()
+        self.chart_cursor = chart.cursor() if chart else None
+        self.lane_randoms = [random.Random(f"{seed}:{lane}") for lane in range(len(keys))]
+        self.next_hit_times = [RANDOM_START_MS + lane_random.uniform(*gaps)
+                               for lane_random, gaps in zip(self.lane_randoms, random_note_gaps)]
+        self.score = 0
+        self.misses = 0
+
+    # Spawn the notes due by song_time (each one NOTE_LEAD_MS before its hit time)
+    # and move every note, counting the ones that got too late to hit
+    def advance(self, song_time):
+        if self.chart_cursor:
+            for hit_time, lane, duration in self.chart_cursor.due(song_time + NOTE_LEAD_MS):
+                self.note_store.spawn(lane, hit_time, duration)
+        else:
+            for lane, gaps in enumerate(random_note_gaps):
+                while song_time + NOTE_LEAD_MS >= self.next_hit_times[lane]:
+                    self.note_store.spawn(lane, self.next_hit_times[lane])
+                    self.next_hit_times[lane] += self.lane_randoms[lane].uniform(*gaps)
+        self.misses += self.note_store.update(song_time)
+        self.score += self.note_store.finish_holds(song_time)
+
+    # Judge a key press, lane is None for a key that is not a lane key.
+    # Returns the slot of the note that was hit, or None.
+    def key_down(self, lane, press_time):
+        self.advance(press_time)
+        slot = self.note_store.press(lane, press_time) if lane is not None else None
+        if slot is not None:
+            self.score += 1
+        else:
+            self.misses += 1  # Missed the note
+        return slot
+
+    # Letting go of a held note, early releases count as a miss
+    def key_up(self, lane, release_time):
+        self.advance(release_time)
+        held_to_end = self.note_store.release(lane, release_time)
+        if held_to_end:
+            self.score += 1
+        elif held_to_end is False:
+            self.misses += 1
+
+    # Every chart note has been spawned and dealt with
+    def chart_done(self):
+        return self.chart_cursor is not None and self.chart_cursor.done() and not self.note_store
+
+# Function to draw the notes, returns the areas drawn for the dirty rect renderer
+def draw_notes(note_store):
+    note_rects = []
+    for slot in note_store.live_slots().tolist():
+        lane = note_store.lane[slot]
+        tail = round(note_store.duration[slot] * NOTE_SPEED)  # Held notes get a tail above the block
+        x = lane_positions[keys[lane]] + lane_width // 2  # Center the note within the lane
+        note_rect = pygame.Rect(x - lane_width // 4, round(note_store.y[slot]) - tail, lane_width // 2, note_height + tail)  # Adjusted width for block
+        note_rects.append(pygame.draw.rect(screen, lane_colors[lane], note_rect))
+    return note_rects
+
+# Cache of rendered text surfaces so constant strings are only rasterized once.
+# Least recently used surfaces are dropped once the cache goes over its byte budget.
+# Numbers are built from a per-font digit atlas, so a changing counter never
+# needs a new render either.
+class TextCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0  # Bytes currently held by cached surfaces
+        self.surfaces = OrderedDict()  # (font, text, color, antialias) -> surface, oldest first
+        self.digit_atlases = {}  # (font, color, antialias) -> {character: surface}
+
+    def render(self, text_font, text, color, antialias=True):
+        cache_key = (text_font, text, color, antialias)
+        surface = self.surfaces.get(cache_key)
+        if surface is not None:
+            self.surfaces.move_to_end(cache_key)  # Mark as recently used
+            return surface
+
+        surface = text_font.render(text, antialias, color)
+        self.surfaces[cache_key] = surface
+        self.size += surface.get_width() * surface.get_height() * surface.get_bytesize()
+        while self.size > self.budget and len(self.surfaces) > 1:
+            _, old_surface = self.surfaces.popitem(last=False)  # Evict the least recently used
+            self.size -= old_surface.get_width() * old_surface.get_height() * old_surface.get_bytesize()
+        return surface
+
+    def digit_atlas(self, text_font, color, antialias=True):
+        atlas_key = (text_font, color, antialias)
+        atlas = self.digit_atlases.get(atlas_key)
+        if atlas is None:
+            atlas = {character: text_font.render(character, antialias, color) for character in "0123456789-"}
+            self.digit_atlases[atlas_key] = atlas
+        return atlas
+
+    # Draw a mix of strings and numbers in a row, e.g. ("Score: ", 12), and return the area drawn
+    def draw(self, text_font, parts, color, pos, antialias=True):
+        x, y = pos
+        drawn = pygame.Rect(x, y, 0, 0)
+        for part in parts:
+            if isinstance(part, int):
+                atlas = self.digit_atlas(text_font, color, antialias)
+                glyphs = [atlas[character] for character in str(part)]
+            else:
+                glyphs = [self.render(text_font, part, color, antialias)]
+            for glyph in glyphs:
+                drawn.union_ip(screen.blit(glyph, (x, y)))
+                x += glyph.get_width()
+        return drawn
+
+text_cache = TextCache(TEXT_CACHE_BUDGET)
 
 # Function to display score and misses
-def display_score():
-    score_text = font.render(f"Score: {score}  Misses: {misses}", True, WHITE)
-    screen.blit(score_text, (10, 10))
+def display_score(session):
+    return text_cache.draw(font, ("Score: ", session.score, "  Misses: ", session.misses), WHITE, (10, 10))
 
 # Function to display the starting screen with blinking text and a pattern background
+# The screen sleeps in pygame.event.wait() and only redraws when the text blinks,
+# the stars blink or input arrives, and never more than IDLE_FPS times a second.
 def show_start_screen():
-    screen.fill(BLACK)  # Fill screen with black to clear it
-    draw_pattern()  # Draw the background pattern
-    draw_blinking_stars()  # Draw random blinking stars
-    
-    title_text = title_font.render("Rhythm Game", True, WHITE)
-    start_text = font.render("Press SPACE to Start", True, WHITE)
-    
-    # Blinking effect for "Press SPACE to Start"
     global last_blink_time, blink_state
-    if time.time() - last_blink_time > 0.5:
-        last_blink_time = time.time()
-        blink_state = not blink_state  # Toggle visibility
-
-    if blink_state:
-        # Display title and instructions
-        screen.blit(title_text, (SCREEN_WIDTH // 2 - title_text.get_width() // 2, SCREEN_HEIGHT // 4))
-        screen.blit(start_text, (SCREEN_WIDTH // 2 - start_text.get_width() // 2, SCREEN_HEIGHT // 2))
-    
-    pygame.display.update()
+    star_state = None
+    last_redraw = 0
+    redraw = True
 
     # Wait for the player to press space to start
     waiting = True
     while waiting:
-        for event in pygame.event.get():
+        now = time.time()
+
+        # Blinking effect for "Press SPACE to Start"
+        if now - last_blink_time > BLINK_INTERVAL:
+            last_blink_time = now
+            blink_state = not blink_state  # Toggle visibility
+            redraw = True
+        if star_state != (now % 5 < 2.5):  # Stars blink every 5 seconds
+            star_state = now % 5 < 2.5
+            redraw = True
+
+        if redraw and now - last_redraw >= 1 / IDLE_FPS:
+            draw_start_screen()
+            last_redraw = now
+            redraw = False
+
+        # Sleep until the next blink (or until a held back redraw is allowed), unless input comes first
+        wake_time = min(last_blink_time + BLINK_INTERVAL, (now // 2.5 + 1) * 2.5)
+        if redraw:
+            wake_time = min(wake_time, last_redraw + 1 / IDLE_FPS)
+        events = [pygame.event.wait(max(1, int((wake_time - time.time()) * 1000)))] + pygame.event.get()
+
+        for event in events:
+            if event.type == pygame.NOEVENT:
+                continue  # Timed out
+            redraw = True  # Input, or ASSETS_LOADED swapping "Loading..." for the start prompt
             if event.type == pygame.QUIT:
                 pygame.quit()
                 quit()
             if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_SPACE:
+                if event.key == pygame.K_SPACE and asset_loader.done():
                     waiting = False  # Start the game when space is pressed
 
+def draw_start_screen():
+    draw_background()  # Blit the cached background pattern (also clears the screen)
+    draw_blinking_stars()  # Draw random blinking stars
+    
+    title_text = text_cache.render(title_font, "Rhythm Game", WHITE)
+    start_text = text_cache.render(font, "Press SPACE to Start" if asset_loader.done() else "Loading...", WHITE)
+
+    if blink_state:
+        # Display title and instructions
+        screen.blit(title_text, (SCREEN_WIDTH // 2 - title_text.get_width() // 2, SCREEN_HEIGHT // 4))
+        screen.blit(start_text, (SCREEN_WIDTH // 2 - start_text.get_width() // 2, SCREEN_HEIGHT // 2))
+    
+    pygame.display.update()
+
 # Function to display the hit zone bar at the bottom
-def draw_hit_zone():
+def draw_hit_zone(surface):
     hit_zone_rect = pygame.Rect(50, SCREEN_HEIGHT - 100, SCREEN_WIDTH - 100, 20)  # Hit zone (adjusted size)
-    pygame.draw.rect(screen, WHITE, hit_zone_rect, 2)  # Draw a white rectangle as the hit zone
+    pygame.draw.rect(surface, WHITE, hit_zone_rect, 2)  # Draw a white rectangle as the hit zone
 
 # Function to draw the separation lines between lanes
-def draw_separation_lines():
+def draw_separation_lines(surface):
     for i in range(1, len(keys)):  # Create separation lines between the keys
-        pygame.draw.line(screen, WHITE, (lane_positions[keys[i]] - lane_width // 2, 0),
+        pygame.draw.line(surface, WHITE, (lane_positions[keys[i]] - lane_width // 2, 0),
                          (lane_positions[keys[i]] - lane_width // 2, SCREEN_HEIGHT), 2)
 
 # Function to draw the background pattern (random blinking stars)
-def draw_pattern():
+def draw_pattern(surface):
     for y in range(0, SCREEN_HEIGHT, 40):
         for x in range(0, SCREEN_WIDTH, 40):
-            pygame.draw.line(screen, WHITE, (x, y), (x + 20, y + 20), 1)  # Diagonal lines
+            pygame.draw.line(surface, WHITE, (x, y), (x + 20, y + 20), 1)  # Diagonal lines
+
+# Cached static layers. Everything drawn here never changes during play, so it is
+# rendered once off-screen and blitted each frame instead of redrawn line by line.
+background_layer = None  # Black fill + diagonal pattern (drawn under the notes)
+lane_overlay_layer = None  # Separation lines + hit zone (drawn over the notes)
+background_layout = None  # Resolution and lane layout the layers were built for
+
+# Function to (re)build the cached layers when the resolution or lane layout changes
+def build_background_layers():
+    global background_layer, lane_overlay_layer, background_layout
+    layout = (screen.get_size(), lane_width, tuple(lane_positions[key] for key in keys))
+    if layout == background_layout:
+        return
+
+    background_layer = pygame.Surface(screen.get_size()).convert()
+    background_layer.fill(BLACK)
+    draw_pattern(background_layer)
+
+    # Black is the transparent colour; RLE makes blitting the mostly empty overlay cheap
+    lane_overlay_layer = pygame.Surface(screen.get_size()).convert()
+    lane_overlay_layer.fill(BLACK)
+    draw_separation_lines(lane_overlay_layer)
+    draw_hit_zone(lane_overlay_layer)
+    lane_overlay_layer.set_colorkey(BLACK, pygame.RLEACCEL)
+
+    background_layout = layout
+
+# Function to draw the background pattern layer (also clears the screen)
+def draw_background():
+    build_background_layers()
+    screen.blit(background_layer, (0, 0))
+
+# Function to draw the separation lines and hit zone layer on top of the notes
+# (only inside the given rects, when there are any)
+def draw_lane_overlay(rects=None):
+    build_background_layers()
+    if rects is None:
+        screen.blit(lane_overlay_layer, (0, 0))
+        return
+    for rect in rects:
+        screen.blit(lane_overlay_layer, rect, rect)
+
+# Renders a frame either as a full refresh or, when DIRTY_RECTS is on, by restoring
+# only the areas drawn last frame from the background and updating just those
+# areas plus whatever was drawn this frame (notes, stars, score and key labels).
+class FrameRenderer:
+    def __init__(self, dirty_rects, threshold):
+        self.dirty_rects = dirty_rects
+        self.threshold = threshold
+        self.full_refresh = True  # The first frame always has to be pushed whole
+        self.last_rects = []  # Areas drawn last frame (old note, star and text rects)
+        self.rects = []  # Areas drawn this frame (new note, star and text rects)
+
+    # Start a frame by erasing what was drawn on the previous one
+    def begin(self):
+        if self.dirty_rects and not self.full_refresh:
+            build_background_layers()
+            for rect in self.last_rects:
+                screen.blit(background_layer, rect, rect)
+        else:
+            draw_background()
+        self.rects = []
+
+    # Remember an area drawn this frame
+    def add(self, rect):
+        if rect is not None:
+            self.rects.append(rect)
+
+    # Draw the lane overlay over everything that was erased or drawn so far
+    def draw_overlay(self):
+        if self.dirty_rects and not self.full_refresh:
+            draw_lane_overlay(self.last_rects + self.rects)
+        else:
+            draw_lane_overlay()
+
+    # Push the frame to the display
+    def end(self):
+        dirty = self.last_rects + self.rects
+        dirty_area = sum(rect.width * rect.height for rect in dirty)
+        if self.full_refresh or dirty_area > self.threshold * SCREEN_WIDTH * SCREEN_HEIGHT:
+            pygame.display.update()
+        else:
+            pygame.display.update(dirty)
+
+        self.last_rects = self.rects
+        self.full_refresh = not self.dirty_rects
 
 # Function to draw random blinking stars
 def draw_blinking_stars():
     current_time = time.time()
+    star_rects = []
     for i in range(10):  # Draw 10 random stars
         star_x = random.randint(0, SCREEN_WIDTH)
         star_y = random.randint(0, SCREEN_HEIGHT)
@@ -135,120 +585,225 @@ def draw_blinking_stars():
         
         # Only draw the star if it's within the blink period (5 seconds)
         if current_time % 5 < 2.5:  # Make stars blink every 5 seconds
-            pygame.draw.circle(screen, WHITE, (star_x, star_y), star_size)
-
-# Main Game Loop
-def game_loop():
-    global score, misses
+            star_rects.append(pygame.draw.circle(screen, WHITE, (star_x, star_y), star_size))
+    return star_rects
+
+# Song clock for simulated runs: time only moves when advance() is called
+class ManualClock:
+    def __init__(self):
+        self.time = 0.0
+
+    def start(self):
+        self.time = 0.0
+
+    def advance(self, ms):
+        self.time += ms
+
+    def now(self):
+        return self.time
+
+# Stands in for InputCapture with a prepared list of (song time, event type, key),
+# sorted by time. Each event is delivered once the song clock reaches it and is
+# stamped with its scripted time.
+class ScriptedInput:
+    def __init__(self, song_clock, script):
+        self.song_clock = song_clock
+        self.script = deque(script)
+        self.events = deque()
+
+    def poll(self):
+        pygame.event.pump()  # Keep SDL responsive, real input is ignored
+        song_time = self.song_clock.now()
+        while self.script and self.script[0][0] <= song_time:
+            event_time, event_type, key = self.script.popleft()
+            self.events.append((event_time, pygame.event.Event(event_type, key=key)))
+
+    def wait_until(self, deadline):
+        self.poll()
+
+    def drain(self):
+        while self.events:
+            yield self.events.popleft()
+
+# Main Game Loop. By default it plays chart_path (or random notes) in real time.
+# Simulated runs pass their own song clock and input source, a frame limit and
+# an on_frame(profiler) callback that is called after every frame. Random notes
+# come from seed (a fresh one by default) and the key events are recorded to
+# replay_path when one is given. Returns the GameSession with the final score.
+def game_loop(chart_path=None, song_clock=None, input_source=None, max_frames=None, on_frame=None,
+              seed=None, replay_path=None):
+    asset_loader.wait()
     running = True
-    clock = pygame.time.Clock()
-    notes = []
-    last_red_time = time.time()
-    last_blue_time = time.time()
-    last_orange_time = time.time()
-    last_green_time = time.time()
-
-    # Colors for notes: Red, Blue, Orange, Green
-    note_colors = {
-        'red': RED,
-        'blue': BLUE,
-        'orange': ORANGE,
-        'green': GREEN
-    }
-
-    # Track next random times for notes
-    next_red_time = random.uniform(0.5, 2)
-    next_blue_time = random.uniform(1, 3)
-    next_orange_time = random.uniform(1.5, 4)
-    next_green_time = random.uniform(1.5, 2)
-    
-    # Play background music in a loop
-    pygame.mixer.music.play(loops=-1, start=0.0)
-
-    while running:
-        screen.fill(BLACK)  # Fill screen with black to clear it
-        draw_pattern()  # Draw the background pattern
-        draw_blinking_stars()  # Draw random blinking stars
+    renderer = FrameRenderer(DIRTY_RECTS, DIRTY_RECT_THRESHOLD)
+    profiler = FrameProfiler()
+    show_profiler = PROFILER_OVERLAY
+    song_clock = song_clock or SongClock()
+    input_capture = input_source or InputCapture(song_clock)
+    key_lanes = {key_map[key]: lane for lane, key in enumerate(keys)}
+    frame = 0
+    song_time = 0.0
+
+    # Notes come from the chart when one was given, otherwise at random from the seed
+    chart = Chart(chart_path) if chart_path else None
+    if seed is None:
+        seed = random.getrandbits(64)
+    session = GameSession(chart, seed)
+    if chart and chart.song_path():
+        pygame.mixer.music.load(chart.song_path())
+    keysounds = chart.keysound_paths() if chart else []  # Lanes the chart has no hit sound for use the default one
+    audio_engine.load_keysounds(keysounds + hit_sound_files[len(keysounds):])
+
+    # Every judged key event is recorded so the game can be re-simulated (see replay.py)
+    replay_writer = ReplayWriter(replay_path, seed, chart_path or "") if replay_path else None
+
+    # Play background music in a loop (once when playing a chart, its times are for a single play)
+    pygame.mixer.music.play(loops=0 if chart else -1, start=0.0)
+    song_clock.start()
+    next_frame_time = time.perf_counter()
+
+    while running and frame != max_frames:
+        profiler.begin_frame()
+        renderer.begin()  # Restore the background (whole screen, or only last frame's dirty areas)
+        for star_rect in draw_blinking_stars():  # Draw random blinking stars
+            renderer.add(star_rect)
+        profiler.mark("background")
         
         # Event handling
-        for event in pygame.event.get():
+        input_capture.poll()
+        for event_time, event in input_capture.drain():
             if event.type == pygame.QUIT:
                 running = False
 
-            # Key press event handling
+            # Performance overlay and profile export
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_profiler = not show_profiler
+                continue
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                export_profile(profiler)
+                continue
+
+            # Key press event handling, judged by how far the press is from the note's hit time
             if event.type == pygame.KEYDOWN:
-                for note in notes:
-                    if event.key == key_map[note.key] and note.rect.colliderect(pygame.Rect(50, SCREEN_HEIGHT - 100, SCREEN_WIDTH - 100, 20)):
-                        score += 1
-                        note.sound.play()  # Play the corresponding sound for the note
-                        notes.remove(note)
-                        break
-                else:
-                    misses += 1  # Missed the note
-
-        # Generate notes at random intervals
-        current_time = time.time()
-
-        if current_time - last_red_time > next_red_time:
-            notes.append(Note('d', 0, RED, red_sound))  # Red block
-            last_red_time = current_time
-            next_red_time = random.uniform(0.5, 2)  # Set new random time for next Red note
-
-        if current_time - last_blue_time > next_blue_time:
-            notes.append(Note('f', 0, BLUE, blue_sound))  # Blue block
-            last_blue_time = current_time
-            next_blue_time = random.uniform(1, 3)  # Set new random time for next Blue note
-
-        if current_time - last_orange_time > next_orange_time:
-            notes.append(Note('j', 0, ORANGE, orange_sound))  # Orange block
-            last_orange_time = current_time
-            next_orange_time = random.uniform(1.5, 4)  # Set new random time for next Orange note
-
-        if current_time - last_green_time > next_green_time:
-            notes.append(Note('k', 0, GREEN, green_sound))  # Green block
-            last_green_time = current_time
-            next_green_time = random.uniform(1.5, 2)  # Set new random time for next Green note
-
-        # Move and draw notes
-        for note in notes[:]:
-            note.move()
-            note.draw()
-            if note.y > SCREEN_HEIGHT:  # If note goes off screen
-                notes.remove(note)
-                misses += 1
-
-        # Draw separation lines for lanes
-        draw_separation_lines()
-
-        # Draw the hit zone bar at the bottom
-        draw_hit_zone()
+                lane = key_lanes.get(event.key)
+                slot = session.key_down(lane, event_time)
+                if slot is not None:
+                    audio_engine.play(lane, session.note_store.sound[slot])  # Play the corresponding sound for the note
+                if replay_writer:
+                    replay_writer.record(event_time, KEY_DOWN, NO_LANE if lane is None else lane)
+
+            if event.type == pygame.KEYUP and event.key in key_lanes:
+                session.key_up(key_lanes[event.key], event_time)
+                if replay_writer:
+                    replay_writer.record(event_time, KEY_UP, key_lanes[event.key])
+        if replay_writer:
+            replay_writer.tick()
+        profiler.mark("input")
+
+        # Generate notes and move every note in one pass, then draw them. Each note
+        # spawns at the top exactly NOTE_LEAD_MS before its hit time, even if the frame came late.
+        song_time = song_clock.now()
+        session.advance(song_time)
+        if session.chart_done() and not pygame.mixer.music.get_busy():
+            running = False  # Chart finished
+        profiler.mark("update")
+        for note_rect in draw_notes(session.note_store):
+            renderer.add(note_rect)
+
+        # Draw the cached separation lines and hit zone bar over the notes
+        renderer.draw_overlay()
+        profiler.mark("notes")
 
         # Display score and misses
-        display_score()
+        renderer.add(display_score(session))
 
         # Draw the key labels at the bottom (d, f, j, k)
-        draw_key_labels()
-
-        pygame.display.update()  # Update the screen
-        clock.tick(60)  # Cap the frame rate to 60 FPS
-
-    pygame.quit()
+        for label_rect in draw_key_labels():
+            renderer.add(label_rect)
+        profiler.mark("hud")
+
+        if show_profiler:
+            renderer.add(draw_profiler_overlay(profiler))
+            profiler.mark("overlay")
+
+        input_capture.poll()  # Catch input that arrived while drawing before the flip
+        renderer.end()  # Update the screen (whole window, or only the dirty areas)
+        profiler.mark("display")
+
+        # Cap the frame rate (no cap when TARGET_FPS is 0), polling input while waiting
+        if TARGET_FPS:
+            next_frame_time = max(next_frame_time + 1 / TARGET_FPS, time.perf_counter() - 1 / TARGET_FPS)
+            input_capture.wait_until(next_frame_time)
+        profiler.mark("wait")
+        profiler.end_frame()
+
+        frame += 1
+        if on_frame:
+            on_frame(profiler)
+
+    if replay_writer:
+        replay_writer.close(song_time, session.score, session.misses)
+        if replay_writer.error:
+            print(f"Could not save the replay to {replay_path}: {replay_writer.error}")
+    if chart:
+        chart.close()
+    return session
+
+# Function to draw the performance overlay in the top right corner: FPS, a graph of
+# recent frame times against the frame budget and the average ms of every stage
+def draw_profiler_overlay(profiler):
+    stage_means = profiler.stage_means()
+    panel = pygame.Rect(SCREEN_WIDTH - 270, 10, 260, 100 + 22 * len(stage_means))
+    screen.fill(BLACK, panel)
+    pygame.draw.rect(screen, WHITE, panel, 1)
+    text_cache.draw(small_font, ("FPS ", round(profiler.fps())), WHITE, (panel.x + 10, panel.y + 8))
+
+    # One bar per frame, red when the frame went over budget
+    graph = pygame.Rect(panel.x + 10, panel.y + 34, panel.width - 20, 56)
+    budget = 1000 / (TARGET_FPS or 60)
+    for i, frame_time in enumerate(profiler.frame_times(graph.width // 2)):
+        bar_height = round(min(frame_time / (2 * budget), 1) * graph.height)
+        x = graph.x + i * 2
+        pygame.draw.line(screen, GREEN if frame_time <= budget else RED, (x, graph.bottom), (x, graph.bottom - bar_height))
+    pygame.draw.line(screen, WHITE, (graph.x, graph.centery), (graph.right, graph.centery))  # Budget line
+
+    for i, (stage, stage_ms) in enumerate(stage_means.items()):
+        tenths = round(stage_ms * 10)
+        text_cache.draw(small_font, (f"{stage} ", tenths // 10, ".", tenths % 10, " ms"), WHITE,
+                        (panel.x + 10, graph.bottom + 8 + 22 * i))
+    return panel
+
+# Function to save the profiled frames as CSV and as a Chrome trace in the current folder
+def export_profile(profiler):
+    file_name = time.strftime("profile-%Y%m%d-%H%M%S")
+    profiler.export_csv(file_name + ".csv")
+    profiler.export_chrome_trace(file_name + ".json")
+    print(f"Saved {file_name}.csv and {file_name}.json")
 
 # Function to display the key labels at the bottom of the screen (d, f, j, k)
 def draw_key_labels():
+    label_rects = []
     for i, key in enumerate(keys):
-        key_text = font.render(key.upper(), True, WHITE)
+        key_text = text_cache.render(font, key.upper(), WHITE)
         x_pos = lane_positions[key] + lane_width // 2 - key_text.get_width() // 2
-        screen.blit(key_text, (x_pos, SCREEN_HEIGHT - 60))  # Position it near the bottom of the screen
+        label_rects.append(screen.blit(key_text, (x_pos, SCREEN_HEIGHT - 60)))  # Position it near the bottom of the screen
+    return label_rects
 
 # Initialize blinking variables
 last_blink_time = time.time()
 blink_state = True
 
-# Show the start screen and start the game
-show_start_screen()
-game_loop()
+def main():
+    init()
+
+    # Show the start screen and start the game
+    show_start_screen()
+    asset_loader.report()
+    chart_path = sys.argv[1] if len(sys.argv) > 1 else None  # Chart to play (python main.py song.chart), notes spawn at random without one
+    replay_path = os.path.join(REPLAY_DIR, time.strftime("%Y%m%d-%H%M%S.replay")) if REPLAY_DIR else None
+    game_loop(chart_path, replay_path=replay_path)
+
+    # Quit Pygame
+    pygame.quit()
 
-# Quit Pygame
-pygame.quit()
-quit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import csv
+import json
+import time
+from collections import deque
+
+PROFILE_HISTORY = 600  # Frames kept for the overlay graph and exports (10 s at 60 FPS)
+
+
+# Times the stages of every frame. mark(stage) books the time since the previous
+# mark against that stage. The last PROFILE_HISTORY frames are kept in a ring
+# buffer and can be exported as CSV or as a Chrome trace (open it in
+# chrome://tracing or https://ui.perfetto.dev).
+class FrameProfiler:
+    def __init__(self, history=PROFILE_HISTORY):
+        self.frames = deque(maxlen=history)  # (frame start, frame ms, [(name, start, end)]) per frame
+        self.stage_names = []  # Every stage seen so far, in first seen order
+        self.stages = {}  # Stage name -> ms spent in it this frame
+        self.events = []  # (name, start, end) of this frame, perf_counter seconds
+        self.frame_start = self.last_mark = time.perf_counter()
+
+    def begin_frame(self):
+        self.stages = {}
+        self.events = []
+        self.frame_start = self.last_mark = time.perf_counter()
+
+    def record(self, name, start, end):
+        if name not in self.stage_names:
+            self.stage_names.append(name)
+        self.stages[name] = self.stages.get(name, 0.0) + (end - start) * 1000
+        self.events.append((name, start, end))
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.record(stage, self.last_mark, now)
+        self.last_mark = now
+
+    def end_frame(self):
+        frame_time = (time.perf_counter() - self.frame_start) * 1000
+        self.frames.append((self.frame_start, frame_time, self.events))
+
+    # Recent frame times in ms, oldest first
+    def frame_times(self, count=None):
+        frame_times = [frame_time for _, frame_time, _ in self.frames]
+        return frame_times[-count:] if count else frame_times
+
+    def fps(self, count=60):
+        frame_times = self.frame_times(count)
+        if not frame_times:
+            return 0.0
+        return 1000 * len(frame_times) / sum(frame_times)
+
+    # Mean ms per stage over the last count frames
+    def stage_means(self, count=60):
+        frames = list(self.frames)[-count:]
+        totals = dict.fromkeys(self.stage_names, 0.0)
+        for _, _, events in frames:
+            for name, start, end in events:
+                totals[name] += (end - start) * 1000
+        return {name: total / max(1, len(frames)) for name, total in totals.items()}
+
+    # One row per frame: frame number, start and total time, then ms per stage
+    def export_csv(self, path):
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["frame", "start_ms", "frame_ms"] + self.stage_names)
+            first_start = self.frames[0][0] if self.frames else 0.0
+            for frame, (frame_start, frame_time, events) in enumerate(self.frames):
+                stage_times = dict.fromkeys(self.stage_names, 0.0)
+                for name, start, end in events:
+                    stage_times[name] += (end - start) * 1000
+                writer.writerow([frame, f"{(frame_start - first_start) * 1000:.3f}", f"{frame_time:.3f}"]
+                                + [f"{stage_times[name]:.3f}" for name in self.stage_names])
+
+    # Chrome trace event format, one complete ("X") event per frame and per stage
+    def export_chrome_trace(self, path):
+        trace_events = []
+        for frame, (frame_start, frame_time, events) in enumerate(self.frames):
+            trace_events.append({"name": f"frame {frame}", "ph": "X", "pid": 1, "tid": 1,
+                                 "ts": frame_start * 1e6, "dur": frame_time * 1e3})
+            for name, start, end in events:
+                trace_events.append({"name": name, "ph": "X", "pid": 1, "tid": 1,
+                                     "ts": start * 1e6, "dur": (end - start) * 1e6})
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
@@ -0,0 +1,223 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+# Replay file layout (little endian):
+#   header   - magic, format version, random seed, chart id length
+#   chart id - UTF-8 path of the chart that was played, empty for random notes
+#   events   - fixed size records in the order they were judged: song time (ms), kind, lane
+# The last event of a finished game is an END record holding the song time the
+# game stopped at, followed by the score and misses the game ended with.
+REPLAY_MAGIC = b"RGRP"
+REPLAY_VERSION = 1
+HEADER = struct.Struct("<4sHQH")
+EVENT = struct.Struct("<dBB")
+RESULT = struct.Struct("<II")
+
+KEY_DOWN = 0
+KEY_UP = 1
+END = 2
+NO_LANE = 255  # Lane of a press on a key that is not a lane key, it still counts as a miss
+
+REPLAY_BATCH = 256  # Events buffered by the game before they are handed to the writer thread
+REPLAY_FLUSH_MS = 1000  # A partial batch is handed over once it is this old
+
+
+# Records a replay while the game runs. record() only appends to a list, full
+# batches (and every REPLAY_FLUSH_MS, see tick()) are packed and written by a
+# background thread so a frame never waits on the disk.
+class ReplayWriter:
+    def __init__(self, path, seed, chart_id=""):
+        self.path = path
+        self.batch = []
+        self.last_flush = time.perf_counter()
+        self.batches = queue.SimpleQueue()  # Lists of events, then the result, then None
+        self.error = None  # First exception raised while writing, the game carries on without the replay
+        chart_bytes = chart_id.encode("utf-8")
+        header = HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, seed, len(chart_bytes)) + chart_bytes
+        self.thread = threading.Thread(target=self.write_all, args=(header,), name="replay-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, event_time, kind, lane):
+        self.batch.append((event_time, kind, lane))
+        if len(self.batch) >= REPLAY_BATCH:
+            self.flush()
+
+    # Hand the buffered events to the writer thread
+    def flush(self):
+        if self.batch:
+            self.batches.put(self.batch)
+            self.batch = []
+        self.last_flush = time.perf_counter()
+
+    # Called once a frame, flushes a partial batch once it has waited REPLAY_FLUSH_MS
+    def tick(self):
+        if self.batch and (time.perf_counter() - self.last_flush) * 1000 >= REPLAY_FLUSH_MS:
+            self.flush()
+
+    # Write the END record and wait for the writer thread to finish
+    def close(self, end_time, score, misses):
+        self.record(end_time, END, 0)
+        self.flush()
+        self.batches.put((score, misses))
+        self.batches.put(None)
+        self.thread.join()
+
+    def write_all(self, header):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "wb") as replay_file:
+                replay_file.write(header)
+                for batch in iter(self.batches.get, None):
+                    if isinstance(batch, tuple):
+                        replay_file.write(RESULT.pack(*batch))
+                    else:
+                        replay_file.write(b"".join(EVENT.pack(*event) for event in batch))
+                    replay_file.flush()  # A crash only loses the events not handed over or written yet
+        except Exception as error:
+            self.error = error
+            for batch in iter(self.batches.get, None):
+                pass  # Keep draining so close() does not hang
+
+
+# A replay file read back. result is the recorded (score, misses), None when the game never finished.
+class Replay:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as replay_file:
+            data = replay_file.read()
+        if len(data) < HEADER.size:
+            raise ValueError(f"{path} is not a replay file")
+        magic, version, self.seed, chart_id_length = HEADER.unpack_from(data, 0)
+        if magic != REPLAY_MAGIC:
+            raise ValueError(f"{path} is not a replay file")
+        if version != REPLAY_VERSION:
+            raise ValueError(f"{path} uses replay format version {version}, expected {REPLAY_VERSION}")
+
+        events_offset = HEADER.size + chart_id_length
+        self.chart_id = data[HEADER.size:events_offset].decode("utf-8")
+        self.events = []
+        self.end_time = None
+        self.result = None
+        offset = events_offset
+        while offset + EVENT.size <= len(data):
+            event = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            if event[1] == END:
+                self.end_time = event[0]
+                if offset + RESULT.size <= len(data):
+                    self.result = RESULT.unpack_from(data, offset)
+                break
+            self.events.append(event)
+        if self.end_time is None:  # Cut short, play on to the last recorded event
+            self.end_time = self.events[-1][0] if self.events else 0.0
+
+
+# Find the chart a replay was played on: as recorded, or by file name in chart_dir
+def find_chart(chart_id, chart_dir=None):
+    if not chart_id:
+        return None
+    if chart_dir:
+        chart_path = os.path.join(chart_dir, os.path.basename(chart_id))
+        if os.path.exists(chart_path):
+            return chart_path
+    return chart_id
+
+
+# Play a replay back through the game's judgement without a window or sound.
+# Returns the (score, misses) the current rules give it.
+def resimulate(replay, chart_dir=None):
+    import main  # Imported here so the game can import this module without a cycle
+    from chart import Chart
+
+    chart_path = find_chart(replay.chart_id, chart_dir)
+    chart = Chart(chart_path) if chart_path else None
+    try:
+        session = main.GameSession(chart, replay.seed)
+        for event_time, kind, lane in replay.events:
+            if kind == KEY_DOWN:
+                session.key_down(None if lane == NO_LANE else lane, event_time)
+            elif kind == KEY_UP:
+                session.key_up(lane, event_time)
+        session.advance(replay.end_time)
+        return session.score, session.misses
+    finally:
+        if chart:
+            chart.close()
+
+
+# Worker: re-score one replay file
+def score_replay(job):
+    path, chart_dir = job
+    try:
+        replay = Replay(path)
+        return path, replay.result, resimulate(replay, chart_dir), None
+    except Exception as error:
+        return path, None, None, f"{type(error).__name__}: {error}"
+
+
+# Replays given on the command line, folders are searched for .replay files
+def find_replays(paths):
+    replays = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, file_names in os.walk(path):
+                replays.extend(os.path.join(folder, file_name) for file_name in sorted(file_names)
+                               if file_name.endswith(".replay"))
+        else:
+            replays.append(path)
+    return replays
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and re-score rhythm game replays")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    score_parser = commands.add_parser("score", help="re-score replays with the current judgement rules")
+    score_parser.add_argument("replays", nargs="+", help="replay files or folders of them")
+    score_parser.add_argument("--charts", help="folder to look for the charts in (default: the recorded paths)")
+    score_parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    score_parser.add_argument("--changed", action="store_true", help="only list replays whose score changed")
+
+    dump_parser = commands.add_parser("dump", help="print the events of a replay file")
+    dump_parser.add_argument("replay")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        replay = Replay(args.replay)
+        print(f"# seed {replay.seed}, chart {replay.chart_id or '(random notes)'}, "
+              f"{len(replay.events)} events, ended at {replay.end_time:.1f} ms, result {replay.result}")
+        kind_names = {KEY_DOWN: "down", KEY_UP: "up"}
+        for event_time, kind, lane in replay.events:
+            print(f"{event_time:.3f} {kind_names[kind]} {'-' if lane == NO_LANE else lane}")
+        return
+
+    jobs = [(path, args.charts) for path in find_replays(args.replays)]
+    start = time.perf_counter()
+    changed = failed = 0
+    pool = multiprocessing.Pool(min(args.jobs, len(jobs)) or 1)
+    try:
+        for path, recorded, rescored, error in pool.imap_unordered(score_replay, jobs, chunksize=16):
+            if error:
+                failed += 1
+                print(f"{path}: {error}")
+                continue
+            if recorded != rescored:
+                changed += 1
+            elif args.changed:
+                continue
+            recorded_text = "unfinished" if recorded is None else f"{recorded[0]} / {recorded[1]}"
+            print(f"{path}: score / misses {recorded_text} -> {rescored[0]} / {rescored[1]}")
+    finally:
+        pool.close()
+        pool.join()
+    print(f"Re-scored {len(jobs) - failed} replays in {time.perf_counter() - start:.2f} s, "
+          f"{changed} changed, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import pytest
+
+import main
+from chart import Chart, read_text_chart, write_chart
+
+
+def test_game_rejects_chart_with_too_many_lanes(tmp_path):
+    path = str(tmp_path / "six.chart")
+    write_chart(path, [(1000, 5, 0)], lane_count=6)
+    with Chart(path) as chart:
+        with pytest.raises(ValueError, match="6 lanes"):
+            main.GameSession(chart)
+
+
+@pytest.mark.parametrize("line, message", [
+    ("100 0 70000", "duration"),
+    ("-5 0", "time"),
+    ("100 -1", "lane"),
+])
+def test_text_chart_rejects_out_of_range_fields(tmp_path, line, message):
+    path = tmp_path / "song.txt"
+    path.write_text(f"# comment\n0 1\n{line}\n")
+    with pytest.raises(ValueError, match=f"song.txt:3: {message}"):
+        read_text_chart(str(path))
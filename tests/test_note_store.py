@@ -0,0 +1,31 @@
+import main
+
+
+def test_hit_tap_note_frees_its_slot_once():
+    session = main.GameSession()
+    session.next_hit_times = [float("inf")] * len(main.keys)  # No random notes
+    note_store = session.note_store
+    hit_slot = note_store.spawn(0, 1000)
+
+    assert session.key_down(0, 1000) == hit_slot
+    assert sorted(set(note_store.free_slots)) == sorted(note_store.free_slots)
+
+    first = note_store.spawn(1, 2000)
+    second = note_store.spawn(2, 2000)
+    assert first != second
+
+
+def test_held_note_released_late_frees_its_slot_once():
+    session = main.GameSession()
+    session.next_hit_times = [float("inf")] * len(main.keys)  # No random notes
+    note_store = session.note_store
+    note_store.spawn(0, 1000, 300)
+
+    session.key_down(0, 1000)
+    session.key_up(0, 2000)  # Long after the hold ended, its tail is off screen by now
+    assert sorted(set(note_store.free_slots)) == sorted(note_store.free_slots)
+    assert session.score == 2
+
+    first = note_store.spawn(1, 5000)
+    second = note_store.spawn(2, 5000)
+    assert first != second
@@ -0,0 +1,59 @@
+import os
+import time
+
+import replay
+from replay import KEY_DOWN, KEY_UP, Replay, ReplayWriter
+
+
+def test_replay_round_trip(tmp_path):
+    path = str(tmp_path / "game.replay")
+    writer = ReplayWriter(path, 1234, "songs/song.chart")
+    writer.record(1000.5, KEY_DOWN, 2)
+    writer.record(1100.25, KEY_UP, 2)
+    writer.close(5000.0, 1, 3)
+    assert writer.error is None
+
+    game = Replay(path)
+    assert (game.seed, game.chart_id) == (1234, "songs/song.chart")
+    assert game.events == [(1000.5, KEY_DOWN, 2), (1100.25, KEY_UP, 2)]
+    assert (game.end_time, game.result) == (5000.0, (1, 3))
+
+
+def test_partial_batch_is_written_before_close(tmp_path, monkeypatch):
+    monkeypatch.setattr(replay, "REPLAY_FLUSH_MS", 0)
+    path = tmp_path / "game.replay"
+    writer = ReplayWriter(str(path), 1, "")
+    writer.record(500.0, KEY_DOWN, 0)
+    writer.tick()
+    for _ in range(100):  # Give the writer thread time to write it
+        if path.exists() and path.stat().st_size == replay.HEADER.size + replay.EVENT.size:
+            break
+        time.sleep(0.01)
+    assert Replay(str(path)).events == [(500.0, KEY_DOWN, 0)]
+    writer.close(600.0, 0, 1)
+
+
+def test_resimulated_score_matches_live_game_with_late_release(tmp_path, monkeypatch):
+    import pygame
+
+    import main
+    from chart import write_chart
+
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # For the game's sound files
+    main.init(640, 480, headless=True)
+    monkeypatch.setattr(main, "TARGET_FPS", 0)
+
+    # A hold released long after it ended, then two taps that would share a slot if it was freed twice
+    chart_path = str(tmp_path / "holds.chart")
+    write_chart(chart_path, [(1000, 0, 300), (4000, 1, 0), (4600, 2, 0)])
+    script = [(1000, pygame.KEYDOWN, pygame.K_d), (3000, pygame.KEYUP, pygame.K_d),
+              (4000, pygame.KEYDOWN, pygame.K_f), (4600, pygame.KEYDOWN, pygame.K_j)]
+    replay_path = str(tmp_path / "holds.replay")
+    song_clock = main.ManualClock()
+    session = main.game_loop(chart_path, song_clock, main.ScriptedInput(song_clock, script), 330,
+                             lambda profiler: song_clock.advance(1000 / 60), replay_path=replay_path)
+    pygame.mixer.music.stop()
+
+    game = Replay(replay_path)
+    assert game.result == (session.score, session.misses) == (4, 0)
+    assert replay.resimulate(game) == game.result